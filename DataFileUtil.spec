@@ -43,23 +43,42 @@ module DataFileUtil {
 
        Optional parameters:
        unpack - either null, 'uncompress', or 'unpack'. 'uncompress' will cause
-           any bzip or gzip files to be uncompressed. 'unpack' will behave the
-           same way, but it will also unpack tar and zip archive files
-           (uncompressing gzipped or bzipped archive files if necessary). If
-           'uncompress' is specified and an archive file is encountered, an
-           error will be thrown. If the file is an archive, it will be
-           unbundled into the directory containing the original output file.
+           any bzip, gzip, zstd, or xz files to be uncompressed. 'unpack' will
+           behave the same way, but it will also unpack tar and zip archive
+           files (uncompressing gzipped, bzipped, zstd, or xz archive files if
+           necessary). If 'uncompress' is specified and an archive file is
+           encountered, an error will be thrown. If the file is an archive, it
+           will be unbundled into the directory containing the original output
+           file.
            
            Note that if the file name (either as provided by the user or by
            Shock) without the a decompression extension (e.g. .gz, .zip or
            .tgz -> .tar) points to an existing file and unpack is specified,
            that file will be overwritten by the decompressed Shock file.
+       stream_unpack - if true and unpack is specified, decompress and unpack
+           the file as it downloads rather than afterwards. The downloaded
+           file is still saved, but the intermediate decompressed archive
+           (e.g. the .tar file for a .tgz file) is not, and for archive files
+           file_path in the output is the downloaded file. Zip files are
+           unpacked once the download is complete. Default false.
+
+       Optional parameters for shock_to_file_mass only, which are read from
+       the first element of the input list and apply to the whole call.
+       Setting them on any other element is an error:
+       max_parallel - the maximum number of files to download at once.
+           Defaults to the service setting.
+       ignore_errors - if true, a failed download is returned as a structure
+           with only the error field set, rather than failing the whole call.
+           Default false.
     */
     typedef structure {
         string shock_id;
         string handle_id;
         string file_path;
         string unpack;
+        boolean stream_unpack;
+        int max_parallel;
+        boolean ignore_errors;
     } ShockToFileParams;
 
     /* Output from the shock_to_file function.
@@ -74,12 +93,15 @@ module DataFileUtil {
        size - the size of the file in bytes as stored in Shock, prior to
            unpacking.
        attributes - the file attributes, if any, stored in Shock.
+       error - shock_to_file_mass with ignore_errors only. The reason the
+           download failed, in which case no other fields are set.
     */
     typedef structure {
         string node_file_name;
         string file_path;
         int size;
         mapping<string, UnspecifiedObject> attributes;
+        string error;
     } ShockToFileOutput;
 
     /* Download a file from Shock. */
@@ -103,26 +125,41 @@ module DataFileUtil {
            false.
        pack - compress a file or archive a directory before loading to Shock.
            The file_path argument will be appended with the appropriate file
-           extension prior to writing. For gzips only, if the file extension
-           denotes that the file is already compressed, it will be skipped. If
-           file_path is a directory and tarring or zipping is specified, the
-           created file name will be set to the directory name, possibly
-           overwriting an existing file. Attempting to pack the root directory
-           is an error. Do not attempt to pack the scratch space root as noted
-           in the module description.
+           extension prior to writing. For gzips, bzip2s, zstds, and xzs only, if
+           the file extension denotes that the file is already compressed, it
+           will be skipped. If file_path is a directory and tarring or zipping is
+           specified, the created file name will be set to the directory name,
+           possibly overwriting an existing file. Attempting to pack the root
+           directory is an error. Do not attempt to pack the scratch space root
+           as noted in the module description.
            
            The allowed values are:
                gzip - gzip the file given by file_path.
+               bzip2 - bzip2 the file given by file_path.
+               zstd - compress the file given by file_path with zstd.
+               xz - compress the file given by file_path with xz.
                targz - tar and gzip the directory specified by the directory
                    portion of the file_path into the file specified by the
                    file_path.
+               tarzst - as targz but compress the tar file with zstd.
                zip - as targz but zip the directory.
+
+       Optional parameters for file_to_shock_mass only, which are read from
+       the first element of the input list and apply to the whole call.
+       Setting them on any other element is an error:
+       max_parallel - the maximum number of files to upload at once.
+           Defaults to the service setting.
+       ignore_errors - if true, a failed upload is returned as a structure
+           with only the error field set, rather than failing the whole call.
+           Default false.
     */
     typedef structure {
         string file_path;
         mapping<string, UnspecifiedObject> attributes;
         boolean make_handle;
         string pack;
+        int max_parallel;
+        boolean ignore_errors;
     } FileToShockParams;
 
     /* Output of the file_to_shock function.
@@ -131,12 +168,15 @@ module DataFileUtil {
         handle - the new handle, if created. Null otherwise.
         node_file_name - the name of the file stored in Shock.
         size - the size of the file stored in shock.
+        error - file_to_shock_mass with ignore_errors only. The reason the
+            upload failed, in which case no other fields are set.
     */
     typedef structure {
         string shock_id;
         Handle handle;
         string node_file_name;
         string size;
+        string error;
     } FileToShockOutput;
 
     /* Load a file to Shock. */
@@ -154,8 +194,8 @@ module DataFileUtil {
 
     /*
         Using the same logic as unpacking a Shock file, this method will cause
-        any bzip or gzip files to be uncompressed, and then unpack tar and zip
-        archive files (uncompressing gzipped or bzipped archive files if 
+        any bzip, gzip, zstd, or xz files to be uncompressed, and then unpack
+        tar and zip archive files (uncompressing compressed archive files if
         necessary). If the file is an archive, it will be unbundled into the 
         directory containing the original output file.
     */
@@ -170,19 +210,23 @@ module DataFileUtil {
            pack parameter) to load to Shock.
        pack - The format into which the file or files will be packed.
            The file_path argument will be appended with the appropriate file
-           extension prior to writing. For gzips only, if the file extension
-           denotes that the file is already compressed, it will be skipped. If
-           file_path is a directory and tarring or zipping is specified, the
-           created file name will be set to the directory name, possibly
-           overwriting an existing file. Attempting to pack the root directory
-           is an error. Do not attempt to pack the scratch space root as noted
-           in the module description.
+           extension prior to writing. For gzips, bzip2s, zstds, and xzs only, if
+           the file extension denotes that the file is already compressed, it
+           will be skipped. If file_path is a directory and tarring or zipping is
+           specified, the created file name will be set to the directory name,
+           possibly overwriting an existing file. Attempting to pack the root
+           directory is an error. Do not attempt to pack the scratch space root
+           as noted in the module description.
 
            The allowed values are:
                gzip - gzip the file given by file_path.
+               bzip2 - bzip2 the file given by file_path.
+               zstd - compress the file given by file_path with zstd.
+               xz - compress the file given by file_path with xz.
                targz - tar and gzip the directory specified by the directory
                    portion of the file_path into the file specified by the
                    file_path.
+               tarzst - as targz but compress the tar file with zstd.
                zip - as targz but zip the directory.
      */
     typedef structure {
@@ -199,7 +243,8 @@ module DataFileUtil {
     } PackFileResult;
 
     /*
-        Pack a file or directory into gzip, targz, or zip archives.
+        Pack a file or directory into gzip, bzip2, zstd, xz, targz, tarzst, or
+        zip archives.
     */
     funcdef pack_file(PackFileParams params)
         returns (PackFileResult out) authentication required;
@@ -424,20 +469,29 @@ module DataFileUtil {
         Optional parameters:
         ignore_errors - ignore any errors that occur when fetching an object
             and instead insert a null into the returned list.
+        data_to_file - write the data of each object as JSON to a file in the
+            scratch space and return the file path in data_file rather than the
+            data itself. The workspace response is parsed as it's read, so the
+            memory used doesn't grow with the size of the objects.
     */
     typedef structure {
         list<string> object_refs;
         boolean ignore_errors;
+        boolean data_to_file;
     } GetObjectsParams;
     
     /* The data and supplemental info for an object.
     
-        UnspecifiedObject data - the object's data or subset data.
+        UnspecifiedObject data - the object's data or subset data, or null if
+            data_to_file was set.
         object_info info - information about the object.
+        string data_file - the path of the file containing the object's data if
+            data_to_file was set.
     */
     typedef structure {
         UnspecifiedObject data;
         object_info info;
+        string data_file;
     } ObjectData;
     
     /* Results from the get_objects function.
@@ -465,9 +519,19 @@ module DataFileUtil {
         staging_file_subdir_path is file_name
         for file: /data/bulk/user_name/subdir_1/subdir_2/file_name
         staging_file_subdir_path is subdir_1/subdir_2/file_name
+
+      Optional parameters:
+      stream_unpack - if true, decompress and unpack tar, gzip and bzip2 files
+          as they are read from the staging area, without copying them to the
+          scratch area first. Archives are unpacked into the directory
+          containing copy_file_path, and the archive itself is linked or
+          copied to copy_file_path as usual. Compressed files are
+          decompressed to copy_file_path, without the .gz or .bz2 suffix.
+          Other files are copied as usual. Default false.
     */
     typedef structure {
       string staging_file_subdir_path;
+      boolean stream_unpack;
     }DownloadStagingFileParams;
 
     /* Results from the download_staging_file function.
@@ -488,21 +552,43 @@ module DataFileUtil {
       file_url: file URL
       download_type: one of ['Direct Download', 'FTP', 'DropBox', 'Google Drive']
 
+      Optional parameters for download_web_files_mass only, which are read from
+      the first element of the input list and apply to the whole call.
+      Setting them on any other element is an error:
+      max_parallel - the maximum number of files to download at once.
+          Defaults to the service setting.
+      max_per_host - the maximum number of files to download from any one
+          host at once. Defaults to the service setting.
+      ignore_errors - if true, a failed download is returned as a structure
+          with only the error field set, rather than failing the whole call.
+          Default false.
     */
     typedef structure {
       string file_url;
       string download_type;
+      int max_parallel;
+      int max_per_host;
+      boolean ignore_errors;
     }DownloadWebFileParams;
 
     /* Results from the download_web_file function.
 
       copy_file_path: copied file scratch area path
+      error - download_web_files_mass with ignore_errors only. The reason the
+          download failed, in which case no other fields are set.
     */
     typedef structure {
       string copy_file_path;
+      string error;
     }DownloadWebFileOutput;
 
     /* Download a web file to scratch area */
     funcdef download_web_file(DownloadWebFileParams params)
         returns(DownloadWebFileOutput results) authentication required;
+
+    /* Download multiple web files to scratch area. Each file is downloaded
+       into its own directory, and the results are returned in input order.
+    */
+    funcdef download_web_files_mass(list<DownloadWebFileParams> params)
+        returns(list<DownloadWebFileOutput> results) authentication required;
 };
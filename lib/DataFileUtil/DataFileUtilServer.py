@@ -393,6 +393,10 @@ class Application(object):
                              name='DataFileUtil.download_web_file',
                              types=[dict])
         self.method_authentication['DataFileUtil.download_web_file'] = 'required'  # noqa
+        self.rpc_service.add(impl_DataFileUtil.download_web_files_mass,
+                             name='DataFileUtil.download_web_files_mass',
+                             types=[list])
+        self.method_authentication['DataFileUtil.download_web_files_mass'] = 'required'  # noqa
         self.rpc_service.add(impl_DataFileUtil.status,
                              name='DataFileUtil.status',
                              types=[dict])
@@ -11,8 +11,14 @@ import shutil
 import filecmp
 import tarfile
 import zipfile
+import bz2file
 from mock import patch
 import ftplib
+import threading
+import subprocess
+import errno
+import json
+import io
 try:
     from ConfigParser import ConfigParser  # py2 @UnusedImport
 except:
@@ -20,6 +26,7 @@ except:
 
 from Workspace.WorkspaceClient import Workspace
 from DataFileUtil.DataFileUtilImpl import DataFileUtil, ShockException
+from DataFileUtil.DataFileUtilImpl import PooledSession
 from DataFileUtil.DataFileUtilServer import MethodContext
 from biokbase.AbstractHandle.Client import AbstractHandle as HandleService  # @UnresolvedImport @IgnorePep8
 from Workspace.baseclient import ServerError as WorkspaceError
@@ -27,6 +34,90 @@ from DataFileUtil.DataFileUtilImpl import HandleError
 from DataFileUtil.authclient import KBaseAuth as _KBaseAuth
 
 
+class FakeFTPServer(object):
+    '''
+    An in memory FTP server for FakeFTP connections.
+
+    files - a mapping of file names to their contents.
+    commands - the optional commands the server supports, of SIZE and MLST.
+    drops - a mapping of REST offsets to the number of bytes sent before the data
+            connection of the first transfer starting at that offset is dropped.
+    '''
+
+    def __init__(self, files, commands=('SIZE', 'MLST'), drops=None):
+        self.files = files
+        self.commands = commands
+        self.drops = dict(drops or {})
+        self.rests = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def FTP(self, host, timeout=None):
+        with self.lock:
+            self.connections += 1
+        return FakeFTP(self)
+
+
+class FakeFTPDataConnection(io.BytesIO):
+
+    def recv(self, bufsize):
+        return self.read(bufsize)
+
+
+class FakeFTP(object):
+    '''
+    Stands in for the few ftplib.FTP methods DataFileUtil uses.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+
+    def _file(self, name):
+        if name not in self.server.files:
+            raise ftplib.error_perm('550 {}: No such file'.format(name))
+        return self.server.files[name]
+
+    def login(self, user, passwd):
+        return '230 Logged in'
+
+    def cwd(self, path):
+        return '250 OK'
+
+    def voidcmd(self, cmd):
+        return '200 OK'
+
+    def size(self, name):
+        if 'SIZE' not in self.server.commands:
+            raise ftplib.error_perm('500 SIZE not understood')
+        return len(self._file(name))
+
+    def sendcmd(self, cmd):
+        verb, _, name = cmd.partition(' ')
+        if verb not in self.server.commands:
+            raise ftplib.error_perm('500 {} not understood'.format(verb))
+        return '250-Listing\r\n size={};type=file; {}\r\n250 End'.format(
+            len(self._file(name)), name)
+
+    def nlst(self, name):
+        return [name] if name in self.server.files else []
+
+    def transfercmd(self, cmd, rest=None):
+        data = self._file(cmd.partition(' ')[2])
+        start = rest or 0
+        end = len(data)
+        with self.server.lock:
+            self.server.rests.append(start)
+            if start in self.server.drops:
+                end = start + self.server.drops.pop(start)
+        return FakeFTPDataConnection(data[start:end])
+
+    def voidresp(self):
+        return '226 Transfer complete'
+
+    def close(self):
+        pass
+
+
 class DataFileUtilTest(unittest.TestCase):
 
     @classmethod
@@ -38,6 +129,8 @@ class DataFileUtilTest(unittest.TestCase):
         config.read(config_file)
         for nameval in config.items('DataFileUtil'):
             cls.cfg[nameval[0]] = nameval[1]
+        # don't wait for retries of web requests that are meant to fail
+        cls.cfg['web_request_retries'] = '0'
         authServiceUrl = cls.cfg.get(
             'auth-service-url', "https://kbase.us/services/authorization/Sessions/Login")
         auth_client = _KBaseAuth(authServiceUrl)
@@ -202,6 +295,243 @@ class DataFileUtilTest(unittest.TestCase):
             output = fh.read()
         self.assertEqual(output, 'filestoshock2')
 
+    def test_shock_to_file_mass_by_handle(self):
+        infile1 = self.write_file('input1.txt', 'handlemass1')
+        infile2 = self.write_file('input2.txt', 'handlemass2')
+        ret1 = self.impl.file_to_shock_mass(
+            self.ctx,
+            [{'file_path': infile1, 'make_handle': 1},
+             {'file_path': infile2, 'make_handle': 1}])[0]
+        outdir = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        outfile2 = os.path.join(outdir, 'output2.txt')
+        ret2 = self.impl.shock_to_file_mass(
+            self.ctx,
+            [{'handle_id': ret1[0]['handle']['hid'], 'file_path': outdir},
+             {'handle_id': ret1[1]['handle']['hid'], 'file_path': outfile2}]
+        )[0]
+        self.delete_shock_node(ret1[0]['shock_id'])
+        self.delete_shock_node(ret1[1]['shock_id'])
+        self.assertEqual(ret2[0]['file_path'], outdir + '/input1.txt')
+        self.assertEqual(ret2[0]['size'], 11)
+        self.assertEqual(ret2[1]['file_path'], outfile2)
+        self.assertEqual(ret2[1]['node_file_name'], 'input2.txt')
+        with open(outdir + '/input1.txt') as fh:
+            self.assertEqual(fh.read(), 'handlemass1')
+        with open(outfile2) as fh:
+            self.assertEqual(fh.read(), 'handlemass2')
+
+    def test_file_to_shock_mass_ignore_errors(self):
+        infile1 = self.write_file('input1.txt', 'filestoshock1')
+        infile2 = os.path.join(self.cfg['scratch'], 'no_such_file.txt')
+        infile3 = self.write_file('input3.txt', 'filestoshock3')
+        params = [{'file_path': infile1, 'max_parallel': 2,
+                   'ignore_errors': 1},
+                  {'file_path': infile2},
+                  {'file_path': infile3}]
+        ret1 = self.impl.file_to_shock_mass(self.ctx, params)[0]
+        self.delete_shock_node(ret1[0]['shock_id'])
+        self.delete_shock_node(ret1[2]['shock_id'])
+        self.assertEqual(ret1[0]['node_file_name'], 'input1.txt')
+        self.assertEqual(ret1[1].keys(), ['error'])
+        self.assertIn('no_such_file.txt', ret1[1]['error'])
+        self.assertEqual(ret1[2]['node_file_name'], 'input3.txt')
+
+        del params[0]['ignore_errors']
+        with self.assertRaises(IOError):
+            self.impl.file_to_shock_mass(self.ctx, params)
+
+    def test_mass_options_on_later_items(self):
+        infile = self.write_file('input1.txt', 'filestoshock1')
+        for option in ['max_parallel', 'ignore_errors']:
+            with self.assertRaises(ValueError) as context:
+                self.impl.file_to_shock_mass(
+                    self.ctx, [{'file_path': infile}, {'file_path': infile, option: 1}])
+            self.assertEqual(
+                '{} is set on item 2, but may only be set on the first item, where it '
+                'applies to the whole call'.format(option),
+                str(context.exception.message))
+
+    def test_pooled_sessions(self):
+        client = PooledSession(pool_size=2, retries=1)
+        sessions = []
+        t = threading.Thread(target=lambda: sessions.append(client.session()))
+        t.start()
+        t.join()
+        self.assertIs(client.session(), client.session())
+        self.assertIsNot(client.session(), sessions[0])
+        self.assertIs(client.session().get_adapter(self.shockURL),
+                      sessions[0].get_adapter(self.shockURL))
+        resp = client.get(self.shockURL)
+        self.assertTrue(resp.ok)
+        self.assertIn('version', resp.json())
+        # streaming GETs don't retry read errors, their callers resume them
+        self.assertEqual(client.session().get_adapter(self.shockURL).max_retries.read, None)
+        stream_adapter = client.session(stream=True).get_adapter(self.shockURL)
+        self.assertEqual(stream_adapter.max_retries.read, 0)
+        self.assertEqual(stream_adapter.max_retries.total, 1)
+        resp = client.get(self.shockURL, stream=True)
+        self.assertTrue(resp.ok)
+        resp.close()
+        # a streamed body can only be sent once, so it's never retried
+        with patch.object(requests.Session, 'post', autospec=True) as post:
+            client.post(self.shockURL, data='body')
+            client.post(self.shockURL, data=iter(['body']))
+        retries = [c[0][0].get_adapter(self.shockURL).max_retries for c in post.call_args_list]
+        self.assertEqual(retries[0].total, 1)
+        self.assertEqual(retries[1].total, 0)
+
+    def test_download_in_segments(self):
+        ret1 = self.impl.file_to_shock(self.ctx,
+                                       {'file_path': 'data/words.txt'})[0]
+        sid = ret1['shock_id']
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        # 249296 bytes -> 4 full segments and one partial segment
+        with patch.object(self.impl, 'SHOCK_DOWNLOAD_SEGMENT_SIZE', 50000), \
+                patch.object(self.impl, 'SHOCK_DOWNLOAD_CONNECTIONS', 3):
+            ret2 = self.impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                                      'file_path': td})[0]
+        self.delete_shock_node(sid)
+        self.assertEqual(ret2['size'], 249296)
+        self.assertEqual(ret2['file_path'], td + '/words.txt')
+        self.assertTrue(filecmp.cmp('data/words.txt', td + '/words.txt',
+                                    shallow=False))
+
+    def test_upload_in_parts(self):
+        # 249296 bytes -> 4 full parts and one partial part
+        with patch.object(self.impl, 'SHOCK_UPLOAD_PARTS_THRESHOLD', 100000), \
+                patch.object(self.impl, 'SHOCK_UPLOAD_PART_SIZE', 50000), \
+                patch.object(self.impl, 'SHOCK_UPLOAD_CONNECTIONS', 3):
+            ret1 = self.impl.file_to_shock(self.ctx,
+                                           {'file_path': 'data/words.txt',
+                                            'attributes': {'foo': 'bar'}})[0]
+        sid = ret1['shock_id']
+        self.assertEqual(ret1['size'], 249296)
+        self.assertEqual(ret1['node_file_name'], 'words.txt')
+        self.assertEqual(os.listdir(os.path.join(self.cfg['scratch'],
+                                                 '.shock_uploads')), [])
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        ret2 = self.impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                                  'file_path': td})[0]
+        self.delete_shock_node(sid)
+        self.assertEqual(ret2['attributes'], {'foo': 'bar'})
+        self.assertTrue(filecmp.cmp('data/words.txt', td + '/words.txt',
+                                    shallow=False))
+
+    def test_upload_packed_in_parts(self):
+        # a source larger than the threshold is packed to a file, not streamed, so the
+        # upload can be resumed, even though the packed file is smaller
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        shutil.copy('data/words.txt', td)
+        with patch.object(self.impl, 'SHOCK_UPLOAD_PARTS_THRESHOLD', 100000), \
+                patch.object(self.impl, 'SHOCK_UPLOAD_PART_SIZE', 50000), \
+                patch.object(self.impl, '_upload_shock_stream') as upload_stream:
+            ret1 = self.impl.file_to_shock(self.ctx, {'file_path': td + '/words.txt',
+                                                      'pack': 'gzip'})[0]
+        upload_stream.assert_not_called()
+        sid = ret1['shock_id']
+        self.assertEqual(ret1['node_file_name'], 'words.txt.gz')
+        td2 = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        ret2 = self.impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                                  'file_path': td2,
+                                                  'unpack': 'uncompress'})[0]
+        self.delete_shock_node(sid)
+        self.assertEqual(ret2['file_path'], td2 + '/words.txt')
+        self.assertTrue(filecmp.cmp('data/words.txt', td2 + '/words.txt', shallow=False))
+
+    def test_download_cached(self):
+        cfg = dict(self.cfg)
+        cfg['shock_cache_dir'] = os.path.join(self.cfg['scratch'], 'shockcache')
+        impl = DataFileUtil(cfg)
+        ret1 = impl.file_to_shock(self.ctx, {'file_path': 'data/words.txt'})[0]
+        sid = ret1['shock_id']
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        ret2 = impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                             'file_path': td + '/first.txt'})[0]
+        with patch.object(impl, '_download_shock_file') as download:
+            ret3 = impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                                 'file_path': td})[0]
+            self.assertFalse(download.called)
+        self.delete_shock_node(sid)
+        self.assertEqual(ret2['file_path'], td + '/first.txt')
+        self.assertEqual(ret3['file_path'], td + '/words.txt')
+        self.assertEqual(ret3['size'], 249296)
+        self.assertTrue(filecmp.cmp('data/words.txt', td + '/first.txt',
+                                    shallow=False))
+        self.assertTrue(filecmp.cmp('data/words.txt', td + '/words.txt',
+                                    shallow=False))
+        cache = [os.path.join(cfg['shock_cache_dir'], f)
+                 for f in os.listdir(cfg['shock_cache_dir']) if not f.startswith('.')]
+        self.assertEqual(len(cache), 1)
+        # the downloaded files are copies, not the cache entry
+        self.assertNotEqual(os.stat(cache[0]).st_ino, os.stat(td + '/words.txt').st_ino)
+
+    def test_download_cached_bad_md5(self):
+        cfg = dict(self.cfg)
+        cfg['shock_cache_dir'] = os.path.join(self.cfg['scratch'], 'shockcache_md5')
+        impl = DataFileUtil(cfg)
+        ret1 = impl.file_to_shock(self.ctx, {'file_path': 'data/words.txt'})[0]
+        sid = ret1['shock_id']
+        get_node = impl._get_shock_node
+
+        def bad_md5(*args):
+            node = get_node(*args)
+            node['file']['checksum']['md5'] = 'f' * 32
+            return node
+
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        with patch.object(impl, '_get_shock_node', side_effect=bad_md5):
+            with self.assertRaises(ShockException) as context:
+                impl.shock_to_file(self.ctx, {'shock_id': sid, 'file_path': td})
+        self.delete_shock_node(sid)
+        self.assertIn('expected md5 ' + 'f' * 32, str(context.exception))
+        self.assertEqual([f for f in os.listdir(cfg['shock_cache_dir'])
+                          if not f.startswith('.')], [])
+
+    def test_link_or_copy_fallbacks(self):
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        source = os.path.join(td, 'source.txt')
+        self.write_file(source, 'link or copy')
+        os.chmod(source, 0o640)
+        os.utime(source, (1000000000, 1000000000))
+        call = subprocess.call
+
+        def fail_cp(failing):
+            def cp(args, **kwargs):
+                calls.append(args)
+                if any(f in args for f in failing):
+                    return 1
+                return call(args, **kwargs)
+            return cp
+
+        # reflink fails, hard link
+        calls = []
+        dest = os.path.join(td, 'hardlink.txt')
+        with patch('DataFileUtil.DataFileUtilImpl.subprocess.call',
+                   side_effect=fail_cp(['--reflink=always'])):
+            self.impl._link_or_copy(source, dest, hardlink=True)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(os.stat(source).st_ino, os.stat(dest).st_ino)
+
+        # reflink and hard link fail, then either cp works or it fails as well and the
+        # file is copied in python
+        link_error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        for name, failing in [('cp.txt', ['--reflink=always']), ('python.txt', ['cp'])]:
+            calls = []
+            dest = os.path.join(td, name)
+            self.write_file(dest, 'replaced')
+            with patch('DataFileUtil.DataFileUtilImpl.subprocess.call',
+                       side_effect=fail_cp(failing)), \
+                    patch('DataFileUtil.DataFileUtilImpl.os.link',
+                          side_effect=link_error) as link:
+                self.impl._link_or_copy(source, dest, hardlink=True)
+            self.assertTrue(link.called)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(calls[1][:2], ['cp', '--preserve=mode,timestamps'])
+            self.assertNotEqual(os.stat(source).st_ino, os.stat(dest).st_ino)
+            self.assertTrue(filecmp.cmp(source, dest, shallow=False))
+            self.assertEqual(os.stat(dest).st_mode & 0o777, 0o640)
+            self.assertEqual(os.stat(dest).st_mtime, 1000000000)
+
     def test_unpack(self):
         tmp_dir = self.cfg['scratch']
         test_file = 'file1.txt.bz'
@@ -220,6 +550,70 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(ret1['file_path'],
                          str(os.path.join(unpack_dir, 'file1.txt')))
 
+    def test_unpack_streamed(self):
+        cfg = dict(self.cfg)
+        cfg['stream_unpack'] = 'true'
+        impl = DataFileUtil(cfg)
+        for archive in ['tar1.tgz', 'tar1.tar.bz2']:
+            unpack_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+            archive_path = os.path.join(unpack_dir, archive)
+            shutil.copy('data/' + archive, archive_path)
+            ret1 = impl.unpack_file(self.ctx, {'file_path': archive_path})[0]
+            self.assertEqual(ret1['file_path'], archive_path)
+            # no intermediate tar file
+            self.assertEqual(set(os.listdir(unpack_dir)), set([archive, 'tar1']))
+            self.assertEqual(set(os.listdir(os.path.join(unpack_dir, 'tar1'))),
+                             set(['file1.txt', 'file2.txt']))
+
+    def write_readonly_dir_tgz(self, file_path, link_first=False):
+        # a read only directory containing a file and a hard link to it
+        with tarfile.open(file_path, 'w:gz') as tf:
+            d = tarfile.TarInfo('ro')
+            d.type = tarfile.DIRTYPE
+            d.mode = 0555
+            d.mtime = 1000000
+            tf.addfile(d)
+            link = tarfile.TarInfo('ro/link.txt')
+            link.type = tarfile.LNKTYPE
+            link.linkname = 'ro/file.txt'
+            f = tarfile.TarInfo('ro/file.txt')
+            f.size = 5
+            members = [(f, io.BytesIO(b'hello')), (link, None)]
+            for m, data in reversed(members) if link_first else members:
+                tf.addfile(m, data)
+
+    def check_readonly_dir_unpacked(self, unpack_dir):
+        ro = os.path.join(unpack_dir, 'ro')
+        try:
+            self.assertEqual(os.stat(ro).st_mode & 0777, 0555)
+            self.assertEqual(os.stat(ro).st_mtime, 1000000)
+            self.assertEqual(os.stat(os.path.join(ro, 'link.txt')).st_ino,
+                             os.stat(os.path.join(ro, 'file.txt')).st_ino)
+            with open(os.path.join(ro, 'link.txt')) as f:
+                self.assertEqual(f.read(), 'hello')
+        finally:
+            os.chmod(ro, 0755)
+
+    def test_unpack_streamed_readonly_dir_and_hard_link(self):
+        cfg = dict(self.cfg)
+        cfg['stream_unpack'] = 'true'
+        impl = DataFileUtil(cfg)
+        unpack_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+        archive_path = os.path.join(unpack_dir, 'ro.tgz')
+        self.write_readonly_dir_tgz(archive_path)
+        impl.unpack_file(self.ctx, {'file_path': archive_path})
+        self.check_readonly_dir_unpacked(unpack_dir)
+
+        unpack_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+        archive_path = os.path.join(unpack_dir, 'ro.tgz')
+        self.write_readonly_dir_tgz(archive_path, link_first=True)
+        with self.assertRaises(ValueError) as context:
+            impl.unpack_file(self.ctx, {'file_path': archive_path})
+        self.assertEqual(
+            'Tar file {} has a hard link ro/link.txt to ro/file.txt, which is not an '
+            'earlier file in the archive'.format(archive_path),
+            str(context.exception.message))
+
     def test_unpack_large_zip(self):
         txt_filename = 'large_file.txt'
         zip_filename = 'large_file.txt.zip'
@@ -310,6 +704,8 @@ class DataFileUtilTest(unittest.TestCase):
             {'file_path': file_path, 'pack': 'gzip'})[0]
         self.assertEqual(ret1['node_file_name'], 'input.txt.gz')
         self.assertEqual(ret1['size'], 38)
+        # the compressed file is streamed to Shock, not written to disk
+        self.assertFalse(os.path.exists(file_path + '.gz'))
         shock_id = ret1['shock_id']
         file_path2 = os.path.join(tmp_dir, 'output.txt')
         ret2 = self.impl.shock_to_file(
@@ -362,7 +758,9 @@ class DataFileUtilTest(unittest.TestCase):
              'pack': 'targz'})[0]
         os.chdir(wd)
         self.assertEqual(ret1['node_file_name'], 'target.tar.gz')
-        self.assertGreater(ret1['size'], 220)
+        # compressed by pigz at level 9. Unlike the tarfile stream used before, pigz
+        # reading a pipe stores no file name in the gzip header, so the archive is smaller
+        self.assertGreater(ret1['size'], 120)
         self.assertLess(ret1['size'], 240)
         shock_id = ret1['shock_id']
         file_path2 = os.path.join(tmp_dir, 'output.tgz')
@@ -373,7 +771,7 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(ret2['node_file_name'], 'target.tar.gz')
         self.assertIsNone(ret2['attributes'])
         self.assertEqual(ret2['file_path'], file_path2)
-        self.assertGreater(ret2['size'], 220)
+        self.assertGreater(ret2['size'], 120)
         self.assertLess(ret2['size'], 240)
         with tarfile.open(file_path2) as t:
             self.assertEqual(set(t.getnames()),
@@ -419,7 +817,7 @@ class DataFileUtilTest(unittest.TestCase):
             {'file_path': tmp_dir,
              'pack': 'targz'})[0]
         self.assertEqual(ret1['node_file_name'], 'tartest2.tar.gz')
-        self.assertGreater(ret1['size'], 220)
+        self.assertGreater(ret1['size'], 120)
         self.assertLess(ret1['size'], 240)
         shock_id = ret1['shock_id']
         file_path2 = os.path.join(tmp_dir, 'output.tgz')
@@ -430,7 +828,7 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(ret2['node_file_name'], 'tartest2.tar.gz')
         self.assertIsNone(ret2['attributes'])
         self.assertEqual(ret2['file_path'], file_path2)
-        self.assertGreater(ret1['size'], 220)
+        self.assertGreater(ret1['size'], 120)
         self.assertLess(ret1['size'], 240)
         with tarfile.open(file_path2) as t:
             self.assertEqual(set(t.getnames()),
@@ -505,6 +903,72 @@ class DataFileUtilTest(unittest.TestCase):
         filecmp.cmp('data/file1.txt', td + '/tar1/file1.txt')
         filecmp.cmp('data/file2.txt', td + '/tar1/file2.txt')
 
+    def test_stream_unpack_archive(self):
+        self.check_stream_unpack_archive('data/tar1.tar', 10240)
+        self.check_stream_unpack_archive('data/tar1.tgz.txt', 180)
+        self.check_stream_unpack_archive('data/tar1.tgz', 180)
+        self.check_stream_unpack_archive('data/tar1.tar.bz2', 194)
+        self.check_stream_unpack_archive('data/zip1.zip', 484)
+
+    def check_stream_unpack_archive(self, file_path, size):
+        ret1 = self.impl.file_to_shock(self.ctx, {'file_path': file_path})[0]
+        sid = ret1['shock_id']
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        ret2 = self.impl.shock_to_file(self.ctx, {'shock_id': sid,
+                                                  'file_path': td,
+                                                  'unpack': 'unpack',
+                                                  'stream_unpack': 1
+                                                  }
+                                       )[0]
+        self.delete_shock_node(sid)
+        fn = os.path.basename(file_path)
+        self.assertEqual(ret2['node_file_name'], fn)
+        self.assertEqual(ret2['file_path'], td + '/' + fn)
+        self.assertEqual(ret2['size'], size)
+        self.assertTrue(filecmp.cmp(file_path, td + '/' + fn, shallow=False))
+        self.assertEqual(set(os.listdir(td)), set([fn, 'tar1']))
+        self.assertEqual(set(os.listdir(td + '/tar1')),
+                         set(['file1.txt', 'file2.txt']))
+        filecmp.cmp('data/file1.txt', td + '/tar1/file1.txt')
+        filecmp.cmp('data/file2.txt', td + '/tar1/file2.txt')
+
+    def test_stream_uncompress(self):
+        # gzip data followed by zero padding, which gzip ignores
+        padded = os.path.join(tempfile.mkdtemp(dir=self.cfg['scratch']), 'file1.txt.gz')
+        with open('data/file1.txt.gz', 'rb') as src, open(padded, 'wb') as dst:
+            dst.write(src.read() + '\0' * 512)
+        for f in ['data/file1.txt.gz', 'data/file1.txt.bz2', padded]:
+            ret1 = self.impl.file_to_shock(self.ctx, {'file_path': f})[0]
+            td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+            ret2 = self.impl.shock_to_file(
+                self.ctx, {'shock_id': ret1['shock_id'], 'file_path': td,
+                           'unpack': 'uncompress', 'stream_unpack': 1})[0]
+            self.delete_shock_node(ret1['shock_id'])
+            self.assertEqual(ret2['file_path'], td + '/file1.txt')
+            self.assertTrue(filecmp.cmp('data/file1.txt', td + '/file1.txt',
+                                        shallow=False))
+
+    def test_stream_uncompress_bad_md5(self):
+        ret1 = self.impl.file_to_shock(self.ctx, {'file_path': 'data/file1.txt.gz'})[0]
+        sid = ret1['shock_id']
+        get_node = self.impl._get_shock_node
+
+        def bad_md5(*args):
+            node = get_node(*args)
+            node['file']['checksum']['md5'] = 'f' * 32
+            return node
+
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        with patch.object(self.impl, '_get_shock_node', side_effect=bad_md5):
+            with self.assertRaises(ShockException) as context:
+                self.impl.shock_to_file(
+                    self.ctx, {'shock_id': sid, 'file_path': td,
+                               'unpack': 'uncompress', 'stream_unpack': 1})
+        self.delete_shock_node(sid)
+        self.assertIn('expected md5 ' + 'f' * 32, str(context.exception))
+        # neither the download nor the decompressed file is left behind
+        self.assertEqual(os.listdir(td), [])
+
     def test_uncompress(self):
         self.check_uncompress('data/file1.txt.bz', 44, 'file1.txt')
         self.check_uncompress('data/file1.txt.bz.txt', 44)
@@ -615,6 +1079,72 @@ class DataFileUtilTest(unittest.TestCase):
             output = fh2.read()
         self.assertEqual(output, input_)
 
+    def test_pack_bzip2(self):
+        input_ = 'testbzip2'
+        tmp_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+        file_path = os.path.join(tmp_dir, 'input.txt')
+        with open(file_path, 'w') as fh1:
+            fh1.write(input_)
+        new_file_path = self.impl.pack_file(
+            self.ctx, {'file_path': file_path, 'pack': 'bzip2'})[0]['file_path']
+        self.assertEqual(new_file_path, file_path + '.bz2')
+        with bz2file.BZ2File(new_file_path) as fh2:
+            self.assertEqual(fh2.read(), input_)
+        # already bzipped
+        self.assertEqual(self.impl.pack_file(
+            self.ctx, {'file_path': new_file_path, 'pack': 'bzip2'})[0]['file_path'],
+            new_file_path)
+        os.remove(new_file_path)
+        ret1 = self.impl.file_to_shock(
+            self.ctx, {'file_path': file_path, 'pack': 'bzip2'})[0]
+        self.assertEqual(ret1['node_file_name'], 'input.txt.bz2')
+        self.assertFalse(os.path.exists(new_file_path))
+        ret2 = self.impl.shock_to_file(
+            self.ctx, {'shock_id': ret1['shock_id'], 'file_path': tmp_dir,
+                       'unpack': 'uncompress'})[0]
+        self.delete_shock_node(ret1['shock_id'])
+        self.assertEqual(ret2['file_path'], file_path)
+        with open(file_path) as fh3:
+            self.assertEqual(fh3.read(), input_)
+
+    def test_pack_zstd_and_xz(self):
+        input_ = 'testzstdxz'
+        for pack, ext in [('zstd', '.zst'), ('xz', '.xz')]:
+            tmp_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+            file_path = os.path.join(tmp_dir, 'input.txt')
+            with open(file_path, 'w') as fh1:
+                fh1.write(input_)
+            new_file_path = self.impl.pack_file(
+                self.ctx, {'file_path': file_path, 'pack': pack})[0]['file_path']
+            self.assertEqual(new_file_path, file_path + ext)
+            os.remove(file_path)
+            ret1 = self.impl.unpack_file(
+                self.ctx, {'file_path': new_file_path})[0]
+            self.assertEqual(ret1['file_path'], file_path)
+            with open(file_path) as fh2:
+                self.assertEqual(fh2.read(), input_)
+            ret2 = self.impl.file_to_shock(
+                self.ctx, {'file_path': file_path, 'pack': pack})[0]
+            self.assertEqual(ret2['node_file_name'], 'input.txt' + ext)
+            self.delete_shock_node(ret2['shock_id'])
+
+    def test_pack_tarzst(self):
+        tmp_dir = os.path.join(self.cfg['scratch'], 'packtarzsttest')
+        os.makedirs(tmp_dir)
+        self.write_file(os.path.join(tmp_dir, 'intar1.txt'), 'tar1')
+        self.write_file(os.path.join(tmp_dir, 'intar2.txt'), 'tar2')
+        new_file_path = self.impl.pack_file(
+            self.ctx, {'file_path': os.path.join(tmp_dir, 'target'),
+                       'pack': 'tarzst'})[0]['file_path']
+        self.assertEqual(new_file_path, os.path.join(tmp_dir, 'target.tar.zst'))
+        os.remove(os.path.join(tmp_dir, 'intar1.txt'))
+        os.remove(os.path.join(tmp_dir, 'intar2.txt'))
+        self.impl.unpack_file(self.ctx, {'file_path': new_file_path})
+        with open(os.path.join(tmp_dir, 'intar1.txt')) as fh1:
+            self.assertEqual(fh1.read(), 'tar1')
+        with open(os.path.join(tmp_dir, 'intar2.txt')) as fh2:
+            self.assertEqual(fh2.read(), 'tar2')
+
     def test_pack_tgz_with_no_dir(self):
         tmp_dir = os.path.join(self.cfg['scratch'], 'packtartest')
         os.makedirs(tmp_dir)
@@ -687,6 +1217,87 @@ class DataFileUtilTest(unittest.TestCase):
 
         os.remove(file_path)
 
+    def test_pack_zip_streamed(self):
+        tmp_dir = os.path.join(self.cfg['scratch'], 'packzipstreamtest')
+        os.makedirs(os.path.join(tmp_dir, 'sub'))
+        self.write_file(os.path.join(tmp_dir, 'inzip1.txt'), 'zip1')
+        with open(os.path.join(tmp_dir, 'sub', 'large.bin'), 'wb') as f:
+            # larger than a buffer, so written with a data descriptor
+            f.write(os.urandom(3 * 1024 * 1024))
+        ret1 = self.impl.file_to_shock(
+            self.ctx, {'file_path': tmp_dir + '/target', 'pack': 'zip'})[0]
+        shock_id = ret1['shock_id']
+        self.assertEqual(ret1['node_file_name'], 'target.zip')
+        self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'target.zip')))
+        file_path2 = os.path.join(self.cfg['scratch'], 'packzipstream.zip')
+        self.impl.shock_to_file(
+            self.ctx, {'shock_id': shock_id, 'file_path': file_path2})
+        self.delete_shock_node(shock_id)
+        with zipfile.ZipFile(file_path2) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(set(z.namelist()),
+                             set(['inzip1.txt', 'sub/large.bin']))
+            with open(os.path.join(tmp_dir, 'sub', 'large.bin'), 'rb') as f:
+                self.assertEqual(z.read('sub/large.bin'), f.read())
+
+    def test_pack_zip_parallel(self):
+        tmp_dir = os.path.join(self.cfg['scratch'], 'packzipparalleltest')
+        os.makedirs(tmp_dir)
+        for i in range(3):
+            self.write_file(os.path.join(tmp_dir, 'small{}.txt'.format(i)), 'zip' * i)
+        with open(os.path.join(tmp_dir, 'large.bin'), 'wb') as f:
+            f.write(os.urandom(1024 * 1024) + 'ACGT' * 1024 * 1024)
+        archives = []
+        for n_proc in [1, 3]:
+            with patch.object(self.impl, 'ZIP_N_PROCESSES', n_proc):
+                archives.append(self.impl.pack_file(
+                    self.ctx, {'file_path': tmp_dir + '/target' + str(n_proc),
+                               'pack': 'zip'})[0]['file_path'])
+        self.assertTrue(filecmp.cmp(archives[0], archives[1], shallow=False))
+        with zipfile.ZipFile(archives[1]) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(set(z.namelist()),
+                             set(['small0.txt', 'small1.txt', 'small2.txt',
+                                  'large.bin']))
+
+    def test_unpack_zip_parallel(self):
+        tmp_dir = os.path.join(self.cfg['scratch'], 'unpackzipparalleltest')
+        os.makedirs(tmp_dir)
+        zip_path = os.path.join(tmp_dir, 'genomes.zip')
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as z:
+            for i in range(50):
+                z.writestr('genomes/g{}/seq{}.fa'.format(i % 5, i), '>s\n' + 'ACGT' * i)
+            z.writestr('empty/', '')
+        expected = os.path.join(self.cfg['scratch'], 'unpackzipparallelexpected')
+        with zipfile.ZipFile(zip_path) as z:
+            z.extractall(expected)
+        with patch.object(self.impl, 'ZIP_N_PROCESSES', 3), \
+                patch.object(self.impl, 'ZIP_PREALLOCATE_SIZE', 100):
+            self.impl.unpack_file(self.ctx, {'file_path': zip_path})
+        for i in range(50):
+            name = 'genomes/g{}/seq{}.fa'.format(i % 5, i)
+            self.assertTrue(filecmp.cmp(os.path.join(expected, name),
+                                        os.path.join(tmp_dir, name), shallow=False))
+        self.assertTrue(os.path.isdir(os.path.join(tmp_dir, 'empty')))
+
+    def test_file_type(self):
+        tmp_dir = tempfile.mkdtemp(dir=self.cfg['scratch'])
+        gz = os.path.join(tmp_dir, 'file.gz')
+        with gzip.open(gz, 'w') as f:
+            f.write('gzipped')
+        txt = os.path.join(tmp_dir, 'file.txt')
+        self.write_file(txt, 'plain text')
+        with patch('DataFileUtil.DataFileUtilImpl.magic.from_file',
+                   return_value='text/plain') as from_file:
+            self.assertEqual(self.impl._file_type(gz), 'gzip')
+            self.assertIsNone(self.impl._file_type(txt))
+            self.assertIsNone(self.impl._file_type(txt))
+            self.assertEqual(from_file.call_count, 1)
+            # a changed file is identified again
+            self.write_file(txt, 'more plain text')
+            self.assertIsNone(self.impl._file_type(txt))
+            self.assertEqual(from_file.call_count, 2)
+
     def test_pack_err_no_file_provided(self):
         self.fail_pack(
             {'file_path': ''},
@@ -777,6 +1388,22 @@ class DataFileUtilTest(unittest.TestCase):
             '79261fd9-ae10-4a84-853d-1b8fcd57c8f23: Node not found',
             exception=ShockException)
 
+    def test_download_err_node_not_found_keeps_file(self):
+        # a failed node lookup must not create or truncate the target file
+        td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+        existing = os.path.join(td, 'existing.txt')
+        with open(existing, 'w') as f:
+            f.write('keep me')
+        sid = '79261fd9-ae10-4a84-853d-1b8fcd57c8f23'
+        errtxt = 'Error downloading file from shock node {}: Node not found'.format(sid)
+        self.fail_download({'shock_id': sid, 'file_path': existing}, errtxt,
+                           exception=ShockException)
+        self.fail_download({'shock_id': sid, 'file_path': os.path.join(td, 'new.txt')},
+                           errtxt, exception=ShockException)
+        self.assertEqual(os.listdir(td), ['existing.txt'])
+        with open(existing) as f:
+            self.assertEqual(f.read(), 'keep me')
+
     def test_download_err_node_has_no_file(self):
         # test attempting download on a node without a file.
         res = requests.post(
@@ -1030,6 +1657,96 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEquals(p1['service'], 'DataFileUtil')
         self.assertEquals(p2['service'], 'DataFileUtil')
 
+    def test_get_objects_cached(self):
+        print('**** test_get_objects_cached ****')
+        ws = self.ws_info[0]
+        self.impl.save_objects(self.ctx, {'id': ws, 'objects': [
+            {'name': 'cached', 'type': 'Empty.AType-1.0', 'data': {'thingy': 3}}]})
+        refs = [str(ws) + '/cached']
+        # too big to cache, so never serialized
+        with patch.object(self.impl, 'OBJECT_CACHE_SIZE', 1), \
+                patch.object(self.impl, '_cache_object_in_memory') as cache:
+            self.impl.get_objects(self.ctx, {'object_refs': refs})
+        cache.assert_not_called()
+
+        with patch.object(self.impl, 'OBJECT_CACHE_SIZE', 1024 ** 2):
+            ret1 = self.impl.get_objects(self.ctx, {'object_refs': refs})[0]['data']
+            with patch.object(Workspace, 'get_objects2') as get_objects2:
+                ret2 = self.impl.get_objects(self.ctx, {'object_refs': refs})[0]['data']
+        get_objects2.assert_not_called()
+        self.assertEquals(ret2[0]['data'], {'thingy': 3})
+        self.assertEquals(ret2[0]['info'], ret1[0]['info'])
+
+    def test_get_objects_in_batches(self):
+        print('**** test_get_objects_in_batches ****')
+        ws = self.ws_info[0]
+        objs = [{'name': 'batch' + str(i), 'type': 'Empty.AType-1.0', 'data': {'thingy': i}}
+                for i in range(5)]
+        self.impl.save_objects(self.ctx, {'id': ws, 'objects': objs})
+        refs = [str(ws) + '/batch' + str(i) for i in [3, 0, 4, 1, 2]]
+        with patch.object(self.impl, 'GET_OBJECTS_BATCH_SIZE', 1), \
+                patch.object(self.impl, 'GET_OBJECTS_BATCH_COUNT', 2), \
+                patch.object(self.impl, 'GET_OBJECTS_CONNECTIONS', 2), \
+                patch.object(self.impl, 'OBJECT_CACHE_SIZE', 0):
+            ret = self.impl.get_objects(self.ctx, {'object_refs': refs})[0]['data']
+        self.assertEquals([o['data']['thingy'] for o in ret], [3, 0, 4, 1, 2])
+        self.assertEquals([o['info'][1] for o in ret],
+                          ['batch3', 'batch0', 'batch4', 'batch1', 'batch2'])
+
+        # requests that fit in one batch skip the object info lookup
+        with patch.object(self.impl, 'GET_OBJECTS_BATCH_COUNT', 5), \
+                patch.object(self.impl, 'OBJECT_CACHE_SIZE', 0), \
+                patch.object(Workspace, 'get_object_info_new') as get_object_info_new:
+            ret = self.impl.get_objects(self.ctx, {'object_refs': refs})[0]['data']
+        get_object_info_new.assert_not_called()
+        self.assertEquals([o['data']['thingy'] for o in ret], [3, 0, 4, 1, 2])
+
+    def test_get_objects_data_to_file(self):
+        print('**** test_get_objects_data_to_file ****')
+        ws = self.ws_info[0]
+        data = {'thingy': 4, 'things': [1.5, None, True, u'caf\xe9', {'a': []}]}
+        self.impl.save_objects(self.ctx, {'id': ws, 'objects': [
+            {'name': 'tofile', 'type': 'Empty.AType-1.0', 'data': data}]})
+        ret = self.impl.get_objects(self.ctx, {'object_refs': [str(ws) + '/tofile'],
+                                               'data_to_file': 1})[0]['data']
+        self.assertIsNone(ret[0]['data'])
+        self.assertEquals(ret[0]['info'][1], 'tofile')
+        with open(ret[0]['data_file']) as f:
+            self.assertEquals(json.load(f), data)
+
+    def test_save_objects_in_batches(self):
+        print('**** test_save_objects_in_batches ****')
+        ws = self.ws_info[0]
+        objs = [{'name': 'savebatch' + str(i), 'type': 'Empty.AType-1.0',
+                 'data': {'thingy': i}} for i in range(5)]
+        with patch.object(self.impl, 'SAVE_OBJECTS_BATCH_COUNT', 2):
+            info = self.impl.save_objects(self.ctx, {'id': ws, 'objects': objs})[0]
+        self.assertEquals([i[1] for i in info], ['savebatch' + str(i) for i in range(5)])
+
+        # a save that fits in one batch is a single save_objects call, with its error as is
+        objs[1]['data'] = None
+        with patch.object(self.impl, '_save_objects_in_batches') as save_in_batches:
+            with self.assertRaises(WorkspaceError) as context:
+                self.impl.save_objects(self.ctx, {'id': ws, 'objects': objs})
+        save_in_batches.assert_not_called()
+        self.assertNotIn('Error saving objects', context.exception.message)
+
+        # a repeated name saves the batches in order, so the versions follow the input order
+        objs = [{'name': 'savebatch' + str(i % 2), 'type': 'Empty.AType-1.0',
+                 'data': {'thingy': i}} for i in range(3)]
+        with patch.object(self.impl, 'SAVE_OBJECTS_BATCH_COUNT', 1):
+            info = self.impl.save_objects(self.ctx, {'id': ws, 'objects': objs})[0]
+        self.assertEquals([(i[1], i[4]) for i in info],
+                          [('savebatch0', 2), ('savebatch1', 2), ('savebatch0', 3)])
+
+        objs[1]['data'] = None
+        with patch.object(self.impl, 'SAVE_OBJECTS_BATCH_COUNT', 1):
+            with self.assertRaises(WorkspaceError) as context:
+                self.impl.save_objects(self.ctx, {'id': ws, 'objects': objs})
+        self.assertIn('Error saving objects 2 to 2 of 3: Object 1, savebatch1, has no ' +
+                      'data. Objects 1 to 1 were saved, the rest were not.',
+                      context.exception.message)
+
     def test_save_objects_no_objects(self):
         self.fail_save_objects({'id': 1},
                                'Required parameter objects missing')
@@ -1133,6 +1850,46 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(len(p['input_ws_objects']), 1)
         self.assertEqual(len(p['resolved_ws_objects']), 1)
 
+    def test_save_objects_provenance_not_shared(self):
+        prov = [{'service': 'svc', 'method_params': [{'big': 'x' * 1000}],
+                 'input_ws_objects': ['1/1/1']},
+                {'service': 'caller'}]
+
+        class Prov(MethodContext):
+            def provenance(self): return prov
+
+        expected_prov = json.loads(json.dumps(prov))
+        objs = [{'name': 'o1', 'type': 'Empty.AType-1.0', 'data': {},
+                 'extra_provenance_input_refs': ['1/2/1']},
+                {'name': 'o2', 'type': 'Empty.AType-1.0', 'data': {}},
+                {'name': 'o3', 'type': 'Empty.AType-1.0', 'data': {},
+                 'extra_provenance_input_refs': ['1/3/1', '1/4/1']},
+                {'name': 'o4', 'type': 'Empty.AType-1.0', 'data': {},
+                 'extra_provenance_input_refs': []}]
+        ctx = Prov({'token': self.token, 'user_id': self.user_id, 'authenticated': 1})
+        with patch.object(Workspace, 'save_objects', return_value=[]) as save:
+            self.impl.save_objects(ctx, {'id': self.ws_info[0], 'objects': objs})
+        saved = save.call_args[0][0]['objects']
+        self.assertEqual([o['name'] for o in saved], ['o1', 'o2', 'o3', 'o4'])
+        self.assertEqual([o['provenance'][0]['input_ws_objects'] for o in saved],
+                         [['1/1/1', '1/2/1'], ['1/1/1'], ['1/1/1', '1/3/1', '1/4/1'],
+                          ['1/1/1']])
+        # the rest of the provenance is the caller's, and the caller's is unchanged
+        for o in saved:
+            self.assertEqual(o['provenance'][0]['service'], 'svc')
+            self.assertEqual(o['provenance'][1:], expected_prov[1:])
+        self.assertEqual(prov, expected_prov)
+        # objects with extra refs each have their own first action and refs list
+        for o in [saved[0], saved[2]]:
+            self.assertIsNot(o['provenance'][0], prov[0])
+            self.assertIsNot(o['provenance'][0]['input_ws_objects'],
+                             prov[0]['input_ws_objects'])
+        self.assertIsNot(saved[0]['provenance'][0], saved[2]['provenance'][0])
+        saved[0]['provenance'][0]['input_ws_objects'].append('1/5/1')
+        self.assertEqual(saved[2]['provenance'][0]['input_ws_objects'],
+                         ['1/1/1', '1/3/1', '1/4/1'])
+        self.assertEqual(prov, expected_prov)
+
     def test_get_objects_with_references(self):
         print('**** test_get_objects_with_references ****')
         ws = self.ws_info[0]
@@ -1160,6 +1917,13 @@ class DataFileUtilTest(unittest.TestCase):
             'Error on ObjectSpecification #1: Illegal character in ' +
             'workspace name bad%ws: %',
             exception=WorkspaceError)
+        # the error comes from get_objects2 even if the object info is looked up first
+        with patch.object(self.impl, 'GET_OBJECTS_BATCH_COUNT', 0):
+            self.fail_get_objects(
+                {'object_refs': ['bad%ws/1/1']},
+                'Error on ObjectSpecification #1: Illegal character in ' +
+                'workspace name bad%ws: %',
+                exception=WorkspaceError)
 
     def test_get_objects_no_objs(self):
         self.fail_get_objects({'object_refs': []},
@@ -1327,6 +2091,57 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(os.stat(os.path.join("data", "zip1.zip")).st_size,
                             os.stat(ret1['copy_file_path']).st_size)
 
+    @patch.object(DataFileUtil, "STAGING_FILE_PREFIX", new='/kb/module/work/tmp/')
+    def test_download_staging_file_stream_unpack(self):
+        tmp_dir = self.cfg['scratch']
+        staging_dir = os.path.join(tmp_dir, self.ctx['user_id'],
+                                   'test_download_stream_unpack_staging_file')
+        if not os.path.exists(staging_dir):
+            os.makedirs(staging_dir)
+        for test_file in ['tar1.tgz', 'file1.txt.gz', 'zip1.zip']:
+            shutil.copy('data/' + test_file, os.path.join(staging_dir, test_file))
+
+        ret1 = self.impl.download_staging_file(
+            self.ctx,
+            {'staging_file_subdir_path':
+             'test_download_stream_unpack_staging_file/tar1.tgz',
+             'stream_unpack': 1})[0]
+        # the archive is unpacked as it's read, then kept next to its contents
+        copy_dir = os.path.dirname(ret1['copy_file_path'])
+        self.assertEqual(os.path.basename(ret1['copy_file_path']), 'tar1.tgz')
+        self.assertTrue(filecmp.cmp(os.path.join('data', 'tar1.tgz'),
+                                    ret1['copy_file_path'], shallow=False))
+        self.assertTrue(filecmp.cmp(os.path.join('data', 'file1.txt'),
+                                    os.path.join(copy_dir, 'tar1', 'file1.txt'),
+                                    shallow=False))
+
+        ret2 = self.impl.download_staging_file(
+            self.ctx,
+            {'staging_file_subdir_path':
+             'test_download_stream_unpack_staging_file/file1.txt.gz',
+             'stream_unpack': 1})[0]
+        self.assertEqual(os.path.basename(ret2['copy_file_path']), 'file1.txt')
+        self.assertFalse(os.path.exists(ret2['copy_file_path'] + '.gz'))
+        self.assertTrue(filecmp.cmp(os.path.join('data', 'file1.txt'),
+                                    ret2['copy_file_path'], shallow=False))
+
+        # zip files can't be read as a stream, so they're copied first
+        ret3 = self.impl.download_staging_file(
+            self.ctx,
+            {'staging_file_subdir_path':
+             'test_download_stream_unpack_staging_file/zip1.zip',
+             'stream_unpack': 1})[0]
+        self.assertTrue(set(['tar1', 'zip1.zip']) <=
+                        set(os.listdir(os.path.dirname(ret3['copy_file_path']))))
+
+        self.write_readonly_dir_tgz(os.path.join(staging_dir, 'ro.tgz'))
+        ret4 = self.impl.download_staging_file(
+            self.ctx,
+            {'staging_file_subdir_path':
+             'test_download_stream_unpack_staging_file/ro.tgz',
+             'stream_unpack': 1})[0]
+        self.check_readonly_dir_unpacked(os.path.dirname(ret4['copy_file_path']))
+
     def fail_download_web_file(self, params, error, 
                                         exception=ValueError, startswith=False):
         with self.assertRaises(exception) as context:
@@ -1453,6 +2268,20 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(os.path.basename(ret1['copy_file_path']),
                          'SP1.fq')
 
+    def test_download_direct_link_in_segments(self):
+        file_url = 'http://molb7621.github.io/workshop/_downloads/SP1.fq'
+        params = {
+            'download_type': 'Direct Download',
+            'file_url': file_url
+        }
+        ret1 = self.impl.download_web_file(self.ctx, params)[0]
+        single = ret1['copy_file_path'] + '.single'
+        shutil.move(ret1['copy_file_path'], single)
+        with patch.object(self.impl, 'WEB_DOWNLOAD_SEGMENT_SIZE', 1000):
+            ret2 = self.impl.download_web_file(self.ctx, params)[0]
+        self.assertEqual(ret2['copy_file_path'], ret1['copy_file_path'])
+        self.assertTrue(filecmp.cmp(single, ret2['copy_file_path'], shallow=False))
+
     def test_download_direct_link_compress_file(self):
         # Box direct download link of 'file1.txt.bzip'
         file_url = 'https://anl.box.com/shared/static/'
@@ -1680,7 +2509,105 @@ class DataFileUtilTest(unittest.TestCase):
         self.assertEqual(os.stat(os.path.join("data", "zip1.zip")).st_size,
                             os.stat(ret1['copy_file_path']).st_size)
 
-    def mock_retrieve_filepath(file_url):
+    def test_ftp_file_size(self):
+        for commands in [('SIZE', 'MLST'), ('MLST',), ()]:
+            ftp = FakeFTPServer({'f.txt': 'ftp data'}, commands).FTP('ftp.fake')
+            self.assertEqual(self.impl._ftp_file_size(ftp, 'f.txt'),
+                             8 if commands else None)
+            with self.assertRaises(ftplib.error_perm) as context:
+                self.impl._ftp_file_size(ftp, 'missing.txt')
+            self.assertTrue(str(context.exception).startswith('550'))
+
+    def test_download_ftp_link_resume(self):
+        data = ''.join('line {}\n'.format(i) for i in range(1000))
+        server = FakeFTPServer({'f.txt': data}, drops={0: 1000, 1000: 3000})
+        with patch('DataFileUtil.DataFileUtilImpl.ftplib.FTP', server.FTP), \
+                patch.object(self.impl, 'WEB_RETRY_BACKOFF_FACTOR', 0):
+            ret = self.impl.download_web_file(
+                self.ctx, {'download_type': 'FTP',
+                           'file_url': 'ftp://ftp.fake/pub/f.txt'})[0]
+        self.assertEqual(os.path.basename(ret['copy_file_path']), 'f.txt')
+        with open(ret['copy_file_path']) as f:
+            self.assertEqual(f.read(), data)
+        # each dropped transfer is resumed where it stopped on a new connection
+        self.assertEqual(server.rests, [0, 1000, 4000])
+        self.assertEqual(server.connections, 3)
+
+    def test_download_ftp_link_in_segments(self):
+        data = ''.join('line {}\n'.format(i) for i in range(1000))
+        server = FakeFTPServer({'f.txt': data}, drops={2000: 300})
+        with patch('DataFileUtil.DataFileUtilImpl.ftplib.FTP', server.FTP), \
+                patch.object(self.impl, 'WEB_RETRY_BACKOFF_FACTOR', 0), \
+                patch.object(self.impl, 'WEB_DOWNLOAD_SEGMENT_SIZE', 1000), \
+                patch.object(self.impl, 'FTP_DOWNLOAD_CONNECTIONS', 3):
+            ret = self.impl.download_web_file(
+                self.ctx, {'download_type': 'FTP',
+                           'file_url': 'ftp://ftp.fake/pub/f.txt'})[0]
+        with open(ret['copy_file_path']) as f:
+            self.assertEqual(f.read(), data)
+        # 8890 bytes -> 8 full segments and one partial segment, one of them resumed
+        self.assertEqual(sorted(server.rests),
+                         [0, 1000, 2000, 2300, 3000, 4000, 5000, 6000, 7000, 8000])
+        self.assertEqual(server.connections, 10)
+
+    def test_download_web_files_mass(self):
+        # Box direct download links of 'file1.txt' and 'file1.txt.bzip'
+        url_prefix = 'https://anl.box.com/shared/static/'
+        params = [{'download_type': 'Direct Download',
+                   'file_url': url_prefix + '4ero6ld3322gnfcbssegglbdbpdvpzae.txt',
+                   'max_per_host': 1,
+                   'ignore_errors': 1},
+                  {'download_type': 'Direct Download',
+                   'file_url': url_prefix + '67iny8ew2ee7vnycpculjvpsg74i5dav.bzip'},
+                  {'download_type': 'Direct Download',
+                   'file_url': 'http://www.google.com/fake'},
+                  {'download_type': 'Direct Download',
+                   'file_url': url_prefix + '4ero6ld3322gnfcbssegglbdbpdvpzae.txt'}]
+        ret = self.impl.download_web_files_mass(self.ctx, params)[0]
+        self.assertEqual(len(ret), 4)
+        for r in [ret[0], ret[1], ret[3]]:
+            self.assertEqual(os.path.basename(r['copy_file_path']), 'file1.txt')
+            self.assertTrue(filecmp.cmp(os.path.join('data', 'file1.txt'),
+                                        r['copy_file_path'], shallow=False))
+        # each file is downloaded into its own directory
+        self.assertNotEqual(ret[0]['copy_file_path'], ret[3]['copy_file_path'])
+        self.assertEqual(ret[2].keys(), ['error'])
+        self.assertTrue(ret[2]['error'].startswith(
+            'Error contacting server at http://www.google.com/fake. Code: '))
+
+        params[1]['max_per_host'] = 2
+        with self.assertRaises(ValueError) as context:
+            self.impl.download_web_files_mass(self.ctx, params)
+        self.assertEqual('max_per_host is set on item 2, but may only be set on the first '
+                         'item, where it applies to the whole call',
+                         str(context.exception.message))
+
+    def web_response(self, url, data, headers):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers.update(headers)
+        response.headers['Content-Length'] = str(len(data))
+        response.raw = io.BytesIO(data)
+        return response
+
+    def test_download_to_file_single_request(self):
+        url = 'http://web.fake/download/f.txt'
+        data = 'web file data\n' * 100
+        for headers, name in [
+                ({'Content-Disposition': 'attachment;filename="named.txt";'}, 'named.txt'),
+                ({}, 'f.txt')]:
+            td = os.path.abspath(tempfile.mkdtemp(dir=self.cfg['scratch']))
+            with patch.object(self.impl.web, 'get',
+                              return_value=self.web_response(url, data, headers)) as get:
+                file_path = self.impl._download_to_file(url, td)
+            # the name and the contents come from the same response
+            self.assertEqual(get.call_count, 1)
+            self.assertEqual(file_path, os.path.join(td, name))
+            with open(file_path) as f:
+                self.assertEqual(f.read(), data)
+
+    def mock_retrieve_filepath(file_url, response, dest_dir=None):
         print 'Mocking _retrieve_filepath'
         print "Mocking connecting file_url: {}".format(file_url)
         copy_file_path = 'test_file_path'